@@ -1,12 +1,22 @@
+import base64
+import gzip
+import hashlib
 import io
 import json
+import multiprocessing
 import os
 import random
+import shutil
+import sqlite3
 import textwrap
+from concurrent.futures import Future
 from contextlib import contextmanager
+from functools import partial
 from unittest.mock import patch
 
+import numpy as np
 import pytest
+import torch
 
 from wids import DistributedChunkedSampler, wids, wids_specs
 from wids.wids import ChunkedSampler, ShardedSampler, ShardListDataset
@@ -33,6 +43,231 @@ class TestIndexedTarSamples:
         assert "__key__" in sample
         assert ".cls" in sample or ".jpg" in sample
 
+    def test_tarfilereader(self):
+        samples = wids.IndexedTarSamples(
+            path="testdata/ixtest.tar", use_mmap=False, index_file=None
+        )
+        for idx in [0, 5, 9]:
+            expected = self.indexed_samples[idx]
+            sample = samples[idx]
+            assert sample.keys() == expected.keys()
+            for key in sample:
+                if not key.startswith("__"):
+                    assert sample[key].read() == expected[key].read()
+        samples.close()
+
+    def test_tarfilereader_index_file(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "ixtest.tar")
+        shutil.copyfile("testdata/ixtest.tar", path)
+        samples = wids.IndexedTarSamples(path=path, use_mmap=False)
+        assert len(samples) == 10
+        samples.close()
+        assert os.path.exists(path + ".index")
+        assert wids.find_index_file("shard.tar._12_") == "shard.tar.index"
+
+    def test_get_view(self):
+        sample = self.indexed_samples[3]
+        view = self.indexed_samples.get_view(3)
+        assert isinstance(view, wids.SampleView)
+        assert set(view.keys()) == set(sample.keys())
+        assert view["__key__"] == sample["__key__"]
+        for key in sample:
+            if not key.startswith("__"):
+                assert view[key].read() == sample[key].read()
+        view["__index__"] = 3
+        assert view["__index__"] == 3 and len(view) == len(sample) + 1
+
+
+class TestVerifyCache:
+    def test_sidecar(self, tmpdir: str):
+        cachedir = os.path.join(str(tmpdir), "cache")
+        os.mkdir(cachedir)
+        path = os.path.join(str(tmpdir), "ixtest.tar")
+        shutil.copyfile("testdata/ixtest.tar", path)
+        md5sum = "3b3c0afe31e45325b7c4e6dec5235d13"
+        assert wids.cached_file_md5sum(path, cachedir) is None
+        samples = wids.IndexedTarSamples(
+            path=path, md5sum=md5sum, verify_cache=cachedir
+        )
+        assert samples[0]["__key__"] is not None
+        assert samples.md5sum_future is None
+        samples.close()
+        assert wids.cached_file_md5sum(path, cachedir) == md5sum
+        assert sorted(os.listdir(str(tmpdir))) == ["cache", "ixtest.tar"]
+
+    def test_no_sidecar(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "ixtest.tar")
+        shutil.copyfile("testdata/ixtest.tar", path)
+        samples = wids.IndexedTarSamples(
+            path=path, md5sum="3b3c0afe31e45325b7c4e6dec5235d13"
+        )
+        samples[0]
+        samples.close()
+        assert os.listdir(str(tmpdir)) == ["ixtest.tar"]
+
+    def test_verify_after_fork(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "ixtest.tar")
+        shutil.copyfile("testdata/ixtest.tar", path)
+        samples = wids.IndexedTarSamples(
+            path=path, md5sum="3b3c0afe31e45325b7c4e6dec5235d13"
+        )
+        samples.md5sum_future.result()
+        # pretend we are a forked worker holding a future that will never complete
+        samples.md5sum_pid = -1
+        samples.md5sum_future = Future()
+        assert samples[0]["__key__"] is not None
+        assert samples.md5sum_future is None
+        samples.close()
+
+    def test_mismatch(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "ixtest.tar")
+        shutil.copyfile("testdata/ixtest.tar", path)
+        samples = wids.IndexedTarSamples(
+            path=path, md5sum="0" * 32, verify_cache=str(tmpdir)
+        )
+        with pytest.raises(AssertionError):
+            samples[0]
+        # the failure is not forgotten after the first access
+        with pytest.raises(AssertionError):
+            samples[1]
+        with pytest.raises(AssertionError):
+            samples.get_view(0)
+        samples.close()
+        # the sidecar records the actual sum, so the mismatch is caught immediately
+        with pytest.raises(AssertionError):
+            wids.IndexedTarSamples(path=path, md5sum="0" * 32, verify_cache=str(tmpdir))
+
+
+class TestComputeFileMd5sum:
+    def test_md5sum(self):
+        expected = "3b3c0afe31e45325b7c4e6dec5235d13"
+        assert wids.compute_file_md5sum("testdata/ixtest.tar") == expected
+        with open("testdata/ixtest.tar", "rb") as stream:
+            assert wids.compute_file_md5sum(stream) == expected
+
+    def test_algo(self):
+        with open("testdata/ixtest.tar", "rb") as stream:
+            expected = hashlib.sha256(stream.read()).hexdigest()
+        got = wids.compute_file_md5sum("testdata/ixtest.tar", algo="sha256")
+        assert got == expected
+
+    def test_gzip_stream(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "data.gz")
+        with gzip.open(path, "wb") as stream:
+            stream.write(b"hello")
+        with gzip.open(path, "rb") as stream:
+            got = wids.compute_file_md5sum(stream)
+        assert got == hashlib.md5(b"hello").hexdigest()
+
+    def test_cached(self, tmpdir: str):
+        path = os.path.join(str(tmpdir), "data.bin")
+        with open(path, "wb") as stream:
+            stream.write(b"hello")
+        hits = wids.cached_file_digest.cache_info().hits
+        assert wids.compute_file_md5sum(path) == hashlib.md5(b"hello").hexdigest()
+        assert wids.compute_file_md5sum(path) == hashlib.md5(b"hello").hexdigest()
+        assert wids.cached_file_digest.cache_info().hits == hits + 1
+        with open(path, "wb") as stream:
+            stream.write(b"changed")
+        assert wids.compute_file_md5sum(path) == hashlib.md5(b"changed").hexdigest()
+        # same size and a copied mtime, as when downloads reuse one local name
+        st = os.stat(path)
+        with open(path + ".temp", "wb") as stream:
+            stream.write(b"CHANGED")
+        os.utime(path + ".temp", ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(path + ".temp", path)
+        assert wids.compute_file_md5sum(path) == hashlib.md5(b"CHANGED").hexdigest()
+
+    def test_unmappable_stream(self):
+        with open("testdata/ixtest.tar", "rb") as stream:
+            data = stream.read()
+        got = wids.compute_file_md5sum(io.BytesIO(data), chunksize=1000)
+        assert got == hashlib.md5(data).hexdigest()
+
+
+class TestSplitname:
+    def test_splitname(self):
+        assert wids.splitname("a/b/c.jpg") == ("a/b/c", ".jpg")
+        assert wids.splitname("a.b/c.d.e") == ("a.b/c", ".d.e")
+        assert wids.splitname("a.b/c") == ("a", ".b/c")
+
+    def test_group_by_key(self):
+        names = ["a.jpg", "a.cls", "b.jpg", "noext", "b.cls", "x.y/c.jpg"]
+        groups = wids.group_by_key(names)
+        assert [group.tolist() for group in groups] == [[0, 1], [2, 4], [5]]
+        assert wids.group_by_key([]) == []
+
+
+class TestDefaultDecoder:
+    def test_decode(self):
+        sample = {
+            "__key__": "a",
+            ".txt": io.BytesIO(b"hello"),
+            ".cls": io.BytesIO(b"17"),
+            ".json": io.BytesIO(b'{"x": 1}'),
+            ".txt.gz": io.BytesIO(gzip.compress(b"zipped")),
+            ".unknown": b"raw",
+        }
+        decoded = wids.default_decoder(sample, format="PIL")
+        assert decoded["__key__"] == "a"
+        assert decoded[".txt"] == "hello"
+        assert decoded[".cls"] == 17
+        assert decoded[".json"] == {"x": 1}
+        assert decoded[".txt.gz"] == "zipped"
+        assert decoded[".unknown"] == b"raw"
+        assert decoded is sample
+
+    def test_decode_copy(self):
+        sample = {"__key__": "a", ".txt": io.BytesIO(b"hello")}
+        decoded = wids.default_decoder(sample, format="PIL", inplace=False)
+        assert decoded[".txt"] == "hello"
+        assert isinstance(sample[".txt"], io.BytesIO)
+
+    def test_missing_msgpack(self):
+        sample = {"__key__": "a", ".mp": io.BytesIO(b"")}
+        with patch.object(wids, "msgpack", None):
+            with pytest.raises(ImportError):
+                wids.default_decoder(sample)
+
+
+class TestBytesToTensors:
+    def test_roundtrip(self):
+        sample = {
+            "__key__": "a",
+            ".txt": io.BytesIO(b"hello"),
+            ".cls": io.BytesIO(b"17"),
+            ".txt.gz": io.BytesIO(gzip.compress(b"zipped")),
+            ".empty": io.BytesIO(b""),
+        }
+        sample = wids.bytes_to_tensors(
+            sample, keys=[".txt", ".txt.gz", ".empty", ".missing"]
+        )
+        assert sample["__key__"] == "a"
+        assert isinstance(sample[".txt"], torch.Tensor)
+        assert sample[".txt"].dtype == torch.uint8
+        assert sample[".empty"].numel() == 0
+        assert isinstance(sample[".cls"], io.BytesIO)
+        assert ".missing" not in sample
+        decoded = wids.default_decoder(sample, format="PIL")
+        assert decoded[".txt"] == "hello"
+        assert decoded[".cls"] == 17
+        assert decoded[".txt.gz"] == "zipped"
+
+    def test_dataloader(self, tmpdir: str):
+        dataset = wids.ShardListDataset(
+            [dict(url="testdata/mpdata.tar", nsamples=100)],
+            localname=wids.default_localname(str(tmpdir)),
+            transformations=partial(wids.bytes_to_tensors, keys=[".mp"]),
+        )
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, num_workers=1, sampler=range(4)
+        )
+        for i, sample in enumerate(loader):
+            assert isinstance(sample[".mp"], torch.Tensor)
+            expected = dataset.cache.get_shard("testdata/mpdata.tar")[i][".mp"]
+            assert bytes(sample[".mp"].numpy()) == expected.read()
+            assert wids.default_decoder(sample)[".mp"]["x"] == i
+
 
 class TestLRUShards:
     def test_add(self, tmpdir: str):
@@ -48,6 +283,83 @@ class TestLRUShards:
         # assert not os.path.exists(path)
 
 
+class TestHashLocalname:
+    def test_hash_localname(self, tmpdir: str):
+        localname = wids.hash_localname(str(tmpdir))
+        digest = hashlib.sha256(b"http://host/dir").digest()
+        hex16 = base64.urlsafe_b64encode(digest)[:16].decode()
+        for i in range(3):
+            path = localname(f"http://host/dir/shard-{i:06d}.tar")
+            assert path == os.path.join(
+                str(tmpdir), f"data__{hex16}__shard-{i:06d}.tar"
+            )
+        localname.flush()
+        connection = sqlite3.connect(os.path.join(str(tmpdir), "cache.db"))
+        rows = connection.execute("SELECT url, path FROM cache").fetchall()
+        assert len(rows) == 3
+        expected = (
+            "http://host/dir/shard-000000.tar",
+            f"data__{hex16}__shard-000000.tar",
+        )
+        assert expected in rows
+        assert wids.hash_urldir.cache_info().hits >= 2
+        assert not hasattr(wids.hash_dataset_name, "cache_info")
+
+    def test_hash_localname_workers(self, tmpdir: str):
+        localname = wids.hash_localname(str(tmpdir))
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=localname, args=(f"http://host/dir/{i}.tar",))
+            for i in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        connection = sqlite3.connect(os.path.join(str(tmpdir), "cache.db"))
+        rows = connection.execute("SELECT url FROM cache").fetchall()
+        assert len(rows) == 4
+
+
+class TestPrefetch:
+    def test_prefetch(self, tmpdir: str):
+        lru_shards = wids.LRUShards(2, localname=wids.default_localname(str(tmpdir)))
+        lru_shards.prefetch("testdata/ixtest.tar")
+        assert "testdata/ixtest.tar" in lru_shards.pending
+        lru_shards.pending["testdata/ixtest.tar"].result()
+        assert os.path.exists(lru_shards.localname("testdata/ixtest.tar"))
+        shard = lru_shards.get_shard("testdata/ixtest.tar")
+        assert len(shard) == 10
+        assert len(lru_shards.pending) == 0
+
+    def test_prefetch_after_fork(self, tmpdir: str):
+        lru_shards = wids.LRUShards(2, localname=wids.default_localname(str(tmpdir)))
+        lru_shards.prefetch("testdata/ixtest.tar")
+        lru_shards.pending["testdata/ixtest.tar"].result()
+        # pretend we are a forked worker holding a future that will never complete
+        lru_shards.prefetch_pid = -1
+        lru_shards.pending["testdata/ixtest.tar"] = Future()
+        shard = lru_shards.get_shard("testdata/ixtest.tar")
+        assert len(shard) == 10
+        assert lru_shards.prefetch_pid == os.getpid()
+        assert len(lru_shards.pending) == 0
+
+    def test_dataset_prefetch(self, tmpdir: str):
+        dataset = wids.ShardListDataset(
+            [
+                dict(url="testdata/mpdata.tar", nsamples=100),
+                dict(url="testdata/tendata.tar", nsamples=100),
+            ],
+            localname=wids.default_localname(str(tmpdir)),
+            prefetch=True,
+        )
+        dataset[0]
+        dataset.cache.pending["testdata/tendata.tar"].result()
+        assert os.path.exists(dataset.localname("testdata/tendata.tar"))
+        assert dataset[150]["__key__"] == "000050"
+
+
 class TestGz:
     def test_gz(self):
         dataset = wids.ShardListDataset(
@@ -90,6 +402,8 @@ class TestShardListDataset:
         assert len(shard_list_dataset.shards) == 3
         assert shard_list_dataset.lengths == [100, 100, 3]
         assert shard_list_dataset.total_length == 203
+        assert type(shard_list_dataset.total_length) is int
+        assert shard_list_dataset.cum_lengths.dtype == np.int64
 
     def test_length(self, shard_list_dataset: ShardListDataset):
         assert len(shard_list_dataset) == 203
@@ -98,6 +412,14 @@ class TestShardListDataset:
         shard, _, _ = shard_list_dataset.get_shard(0)
         assert os.path.exists(shard.path)
 
+    def test_getshard_inner_index(self, shard_list_dataset: ShardListDataset):
+        for index, expected in [(5, 5), (6, 6), (150, 50), (200, 0), (0, 0), (202, 2)]:
+            index = np.int64(index)
+            _, inner_idx, desc = shard_list_dataset.get_shard(index)
+            assert inner_idx == expected
+            assert type(inner_idx) is int
+            assert desc is shard_list_dataset.shards[index // 100]
+
     def test_getitem(self, shard_list_dataset: ShardListDataset):
         # make sure this was set up correctly
         assert shard_list_dataset.cache.lru.capacity == 2
@@ -161,6 +483,34 @@ class TestShardListDataset:
         assert shard_list_dataset.get_stats() == (5, 4)
 
 
+class TestTransformations:
+    def test_add_transform(self, tmpdir: str):
+        dataset = wids.ShardListDataset(
+            [dict(url="testdata/mpdata.tar", nsamples=100)],
+            localname=wids.default_localname(str(tmpdir)),
+            transformations=lambda sample: sample["__key__"],
+        )
+        assert dataset[3] == "000003"
+        dataset.add_transform(lambda key: key + "!")
+        dataset.add_transform(lambda key: key.upper())
+        assert dataset[3] == "000003!"
+        dataset.transformations.append(lambda key: key + "?")
+        assert dataset[3] == "000003!?"
+
+
+class TestLazyShardListDataset:
+    def test_lazy(self, tmpdir: str):
+        dataset = wids.ShardListDataset(
+            [dict(url="testdata/mpdata.tar", nsamples=100)],
+            localname=wids.default_localname(str(tmpdir)),
+            transformations=lambda sample: (sample["__key__"], sample[".mp"].read()),
+            lazy=True,
+        )
+        key, data = dataset[17]
+        assert key == "000017"
+        assert isinstance(data, bytes) and len(data) > 0
+
+
 class TestSpecs:
     def test_spec_parsing(self):
         spec = textwrap.dedent(
@@ -227,12 +577,40 @@ class TestShardedSampler:
         assert max(indexes) == 202
         assert len(set(indexes)) == 203  # Ensure all indexes are unique
 
+    def test_iter_locality(self, sharded_sampler: ShardedSampler):
+        list(sharded_sampler)
+        indexes = list(sharded_sampler)
+        assert all(type(i) is int for i in indexes)
+        shards = [i // 100 for i in indexes]
+        # each shard is visited in one contiguous run
+        runs = [s for k, s in enumerate(shards) if k == 0 or s != shards[k - 1]]
+        assert sorted(runs) == [0, 1, 2]
+
     def test_iter_with_shuffle(self, sharded_sampler: ShardedSampler):
         indexes1 = list(sharded_sampler)
         indexes2 = list(sharded_sampler)
         assert indexes1 != indexes2  # Ensure order changes with each iteration
 
 
+class TestAlternatingSampler:
+    def test_alternate(self):
+        sampler = ShardedSampler(None, lengths=[10, 10, 10], alternate=True)
+        epochs = [list(sampler) for _ in range(3)]
+        shard_order = [[i // 10 for i in indexes[::10]] for indexes in epochs]
+        assert shard_order == [[0, 1, 2], [2, 1, 0], [0, 1, 2]]
+        assert epochs[0] != epochs[2]  # Samples within shards are still reshuffled
+
+    def test_negative_seed(self):
+        sampler = ShardedSampler(None, lengths=[10, 10], seed=-1)
+        assert sorted(sampler) == list(range(20))
+        sampler = ShardedSampler(
+            None, lengths=[10, 10], seed=-1, alternate=True, shufflefirst=True
+        )
+        assert sorted(sampler) == list(range(20))
+        chunked = ChunkedSampler(list(range(100)), chunksize=10, seed=-1)
+        assert sorted(chunked) == list(range(100))
+
+
 class TestChunkedSampler:
     def setup_method(self):
         self.dataset = list(range(10000))
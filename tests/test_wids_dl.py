@@ -3,7 +3,13 @@ import tempfile
 from functools import partial
 from multiprocessing import Pool
 
-from wids.wids_dl import download_and_open, download_file, recent_downloads
+from wids import wids_dl
+from wids.wids_dl import (
+    download_and_open,
+    download_file,
+    download_only,
+    recent_downloads,
+)
 
 test_download_url = (
     "https://storage.googleapis.com/webdataset/d-tokens/d-tokens-000000.tar"
@@ -36,6 +42,18 @@ def test_download_and_open():
                 os.remove(local)
 
 
+def test_download_only():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local = os.path.join(tmpdir, "ixtest.tar")
+        nopen = len(wids_dl.open_objects)
+        assert download_only("testdata/ixtest.tar", local) == local
+        assert os.path.getsize(local) == os.path.getsize("testdata/ixtest.tar")
+        assert len(wids_dl.open_objects) == nopen
+        # an existing file is left alone
+        download_only("testdata/mpdata.tar", local)
+        assert os.path.getsize(local) == os.path.getsize("testdata/ixtest.tar")
+
+
 def download_and_read(remote, local, *, n=10):
     stream = download_and_open(remote, local)
     data = stream.read(n)
@@ -101,3 +101,17 @@ def test_eviction_and_release_callback():
     assert (
         evicted_keys[0] == "b"
     )  # The key that was evicted should be passed to the release handler
+
+
+# Test that pinned keys are never evicted
+def test_pinned():
+    cache = LRUCache(3)
+    cache.pin("a")
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    cache["d"] = 4
+    cache["e"] = 5
+    assert "a" in cache  # 'a' is the least recently used, but pinned
+    assert "b" not in cache and "c" not in cache
+    assert len(cache) == 3
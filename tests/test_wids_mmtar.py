@@ -3,6 +3,7 @@ import os
 import tarfile
 import time
 
+import numpy as np
 import pytest
 
 from wids.wids_mmtar import MMIndexedTar, keep_while_reading
@@ -96,3 +97,24 @@ def test_concurrent_access(tmpdir):
     # Check that all files have been deleted
     assert not os.path.exists(temp_file1)
     assert not os.path.exists(temp_file2)
+
+
+def test_MMIndexedTar_index(create_tarfile):
+    mmindexedtar = MMIndexedTar(create_tarfile)
+    assert len(mmindexedtar) == 5
+    assert mmindexedtar.offsets.dtype == np.int64
+    assert mmindexedtar.sizes.tolist() == [8] * 5
+    assert mmindexedtar["file3"] == ("file3", b"content3")
+    mmindexedtar.close()
+
+
+def test_MMIndexedTar_get_files(create_tarfile):
+    mmindexedtar = MMIndexedTar(create_tarfile)
+    files = mmindexedtar.get_files([1, 2, 4])
+    assert [name for name, _ in files] == ["file1", "file2", "file4"]
+    assert [stream.read() for _, stream in files] == [
+        b"content1",
+        b"content2",
+        b"content4",
+    ]
+    mmindexedtar.close()
@@ -1,27 +1,44 @@
 import base64
+import bisect
 import gzip
 import hashlib
 import io
+import json
+import mmap
 import os
-import random
+import pickle
 import re
 import sqlite3
 import sys
 import uuid
 import warnings
-from functools import partial
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from multiprocessing.util import Finalize
 from typing import Any, BinaryIO, Dict, Optional, TypeVar, Union
 from urllib.parse import quote, urlparse
 
 import numpy as np
+import torch
 import torch.distributed as dist
 
-from .wids_dl import download_and_open
+from .wids_dl import download_and_open, download_only
 from .wids_lru import LRUCache
 from .wids_mmtar import MMIndexedTar
 from .wids_specs import load_dsdesc_and_resolve, urldir
 from .wids_tar import TarFileReader, find_index_file
 
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 try:
     from torch.utils.data import Dataset, Sampler
 except ImportError:
@@ -38,50 +55,132 @@ T = TypeVar("T")
 T_co = TypeVar("T_co", covariant=True)
 
 
-def compute_file_md5sum(fname: Union[str, BinaryIO], chunksize: int = 1000000) -> str:
-    """Compute the md5sum of a file in chunks.
+def update_digest_from_stream(digest, stream: BinaryIO, chunksize: int = 1000000):
+    """Feed the entire contents of a stream into a hashlib digest.
+
+    Plain file streams (FileIO, BufferedReader) are mmapped and hashed in a
+    single call, which lets hashlib process the whole buffer without returning
+    to the interpreter. Other streams are read in chunks, since wrappers such
+    as gzip.GzipFile expose the fileno of a file with different contents.
+    """
+    fileno = None
+    if isinstance(stream, (io.FileIO, io.BufferedReader)):
+        try:
+            fileno = stream.fileno()
+        except (OSError, io.UnsupportedOperation):
+            fileno = None
+    if fileno is not None and os.fstat(fileno).st_size > 0:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mm:
+            digest.update(mm)
+    else:
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(chunksize), b""):
+            digest.update(chunk)
+    return digest
+
+
+@lru_cache(maxsize=256)
+def cached_file_digest(fname, stat_key, chunksize, algo):
+    """Compute the digest of a file; stat_key identifies the file's contents in the cache key.
+
+    stat_key includes st_ino and st_ctime_ns, since downloaders commonly set
+    mtime from the remote, and a file can be rewritten in place with the same
+    size and mtime; utime can't set ctime.
+    """
+    digest = hashlib.new(algo)
+    with open(fname, "rb") as f:
+        update_digest_from_stream(digest, f, chunksize)
+    return digest.hexdigest()
+
+
+def compute_file_md5sum(
+    fname: Union[str, BinaryIO], chunksize: int = 1000000, algo: str = "md5"
+) -> str:
+    """Compute the md5sum of a file.
 
     Parameters
     ----------
     fname : Union[str, BinaryIO]
         Filename or file object
     chunksize : int, optional
-        Chunk size in bytes, by default 1000000
+        Chunk size in bytes for streams that cannot be mmapped, by default 1000000
+    algo : str, optional
+        Any algorithm supported by hashlib.new, by default "md5"
 
     Returns
     -------
     str
-        MD5 sum of the file
+        Hex digest of the file
 
     Examples
     --------
     >>> compute_file_md5sum("test.txt")
     'd41d8cd98f00b204e9800998ecf8427e'
     """
-    md5 = hashlib.md5()
     if isinstance(fname, str):
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(chunksize), b""):
-                md5.update(chunk)
-    else:
-        fname.seek(0)
-        for chunk in iter(lambda: fname.read(chunksize), b""):
-            md5.update(chunk)
-    return md5.hexdigest()
-
-
-def compute_file_md5sum(fname: Union[str, BinaryIO], chunksize: int = 1000000) -> str:
-    """Compute the md5sum of a file in chunks."""
-    md5 = hashlib.md5()
-    if isinstance(fname, str):
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(chunksize), b""):
-                md5.update(chunk)
-    else:
-        fname.seek(0)
-        for chunk in iter(lambda: fname.read(chunksize), b""):
-            md5.update(chunk)
-    return md5.hexdigest()
+        # repeated checks of an unchanged file are answered from the cache
+        st = os.stat(fname)
+        stat_key = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+        return cached_file_digest(fname, stat_key, chunksize, algo)
+    digest = hashlib.new(algo)
+    update_digest_from_stream(digest, fname, chunksize)
+    return digest.hexdigest()
+
+
+verify_cache_name = "_verify_cache.json"
+verify_pool = None
+verify_pool_pid = None
+
+
+def get_verify_pool():
+    """Return the thread pool used for background checksum verification."""
+    global verify_pool, verify_pool_pid
+    if verify_pool_pid != os.getpid():
+        # threads don't survive a fork, so each DataLoader worker gets its own pool
+        verify_pool = ThreadPoolExecutor(max_workers=2)
+        verify_pool_pid = os.getpid()
+    return verify_pool
+
+
+def read_verify_cache(dirname):
+    """Read the checksum sidecar in dirname, mapping absolute paths to (size, mtime_ns, md5sum)."""
+    try:
+        with open(os.path.join(dirname, verify_cache_name)) as stream:
+            return json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def cached_file_md5sum(path, cachedir):
+    """Return the md5sum recorded for path in cachedir if the file is unchanged, else None."""
+    if cachedir is None:
+        return None
+    st = os.stat(path)
+    entry = read_verify_cache(cachedir).get(os.path.abspath(path))
+    if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+        return entry[2]
+    return None
+
+
+def compute_and_record_file_md5sum(path, cachedir):
+    """Compute the md5sum of path and, if cachedir is given, record it in the sidecar there."""
+    st = os.stat(path)
+    got = compute_file_md5sum(path)
+    if cachedir is None:
+        return got
+    try:
+        cache = read_verify_cache(cachedir)
+        cache[os.path.abspath(path)] = [st.st_size, st.st_mtime_ns, got]
+        # write atomically; concurrent writers may drop each other's entries,
+        # which only costs a recomputation later
+        temp = os.path.join(cachedir, f"{verify_cache_name}.{os.getpid()}.temp")
+        with open(temp, "w") as stream:
+            json.dump(cache, stream)
+        os.replace(temp, os.path.join(cachedir, verify_cache_name))
+    except OSError:
+        # the sidecar is only an optimization, e.g. for read-only directories
+        pass
+    return got
 
 
 def compute_num_samples(fname):
@@ -89,10 +188,17 @@ def compute_num_samples(fname):
     return len(ds)
 
 
+_SPLIT_RE = re.compile(r"^((?:.*/)?.*?)(\..*)$")
+
+
 def splitname(fname):
     """Returns the basename and extension of a filename"""
+    # fast path: the extension starts at the first "." of the last path component
+    dot = fname.find(".", fname.rfind("/") + 1)
+    if dot >= 0:
+        return fname[:dot], fname[dot:]
     assert "." in fname, "Filename must have an extension"
-    basename, extension = re.match(r"^((?:.*/)?.*?)(\..*)$", fname).groups()
+    basename, extension = _SPLIT_RE.match(fname).groups()
     return basename, extension
 
 
@@ -103,30 +209,101 @@ def group_by_key(names):
         names: A list of file names.
 
     Returns:
-        A list of lists of indices, where each sublist contains indices of files
+        A list of int64 arrays of indices, where each array contains indices of files
         with the same key.
     """
-    groups = []
-    last_key = None
-    current = []
-    for i, fname in enumerate(names):
-        # Ignore files that are not in a subdirectory.
-        if "." not in fname:
-            print(f"Warning: Ignoring file {fname} (no '.')")
-            continue
-        key, ext = splitname(fname)
-        if key != last_key:
-            if current:
-                groups.append(current)
-            current = []
-            last_key = key
-        current.append(i)
-    if current:
-        groups.append(current)
-    return groups
-
-
-def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] = True):
+    names = list(names)
+    dots = [fname.find(".", fname.rfind("/") + 1) for fname in names]
+    if -1 not in dots:
+        # fast path: every extension starts in the last path component
+        keys = [fname[:dot] for fname, dot in zip(names, dots)]
+        indexes = np.arange(len(names), dtype=np.int64)
+    else:
+        keys = []
+        indexes = []
+        for i, fname in enumerate(names):
+            if dots[i] >= 0:
+                keys.append(fname[: dots[i]])
+            elif "." in fname:
+                keys.append(splitname(fname)[0])
+            else:
+                # Ignore files that have no extension.
+                print(f"Warning: Ignoring file {fname} (no '.')")
+                continue
+            indexes.append(i)
+        indexes = np.array(indexes, dtype=np.int64)
+    if len(indexes) == 0:
+        return []
+    # find group boundaries with a single vectorized comparison of adjacent keys
+    keys = np.array(keys)
+    bounds = (np.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
+    # slicing with Python ints is much cheaper than np.split for many small groups
+    return [indexes[lo:hi] for lo, hi in zip([0] + bounds, bounds + [len(indexes)])]
+
+
+def decode_text(stream, format):
+    return stream.read().decode("utf-8")
+
+
+def decode_cls(stream, format):
+    return int(stream.read().decode("utf-8"))
+
+
+def decode_image(stream, format):
+    if PIL is None:
+        raise ImportError("PIL is required to decode images")
+    if format == "PIL":
+        return PIL.Image.open(stream)
+    elif format == "numpy":
+        return np.asarray(PIL.Image.open(stream))
+    else:
+        raise ValueError(f"Unknown format: {format}")
+
+
+def decode_json(stream, format):
+    return json.loads(stream.read())
+
+
+def decode_npy(stream, format):
+    return np.load(stream)
+
+
+def decode_msgpack(stream, format):
+    if msgpack is None:
+        raise ImportError("msgpack is required to decode .mp files")
+    return msgpack.unpackb(stream.read(), raw=False)
+
+
+def decode_torch(stream, format):
+    return torch.load(stream)
+
+
+def decode_pickle(stream, format):
+    return pickle.load(stream)
+
+
+default_decoders = {
+    extension: decoder
+    for extensions, decoder in [
+        (["txt", "text"], decode_text),
+        (["cls", "cls2"], decode_cls),
+        (["jpg", "png", "ppm", "pgm", "pbm", "pnm"], decode_image),
+        (["json"], decode_json),
+        (["npy"], decode_npy),
+        (["mp"], decode_msgpack),
+        (["pt", "pth"], decode_torch),
+        (["pickle", "pkl"], decode_pickle),
+    ]
+    for extension in extensions
+}
+
+
+def default_decoder(
+    sample: Dict[str, Any],
+    format: Optional[Union[bool, str]] = True,
+    *,
+    inplace: bool = True,
+):
     """A default decoder for webdataset.
 
     This handles common file extensions: .txt, .cls, .cls2,
@@ -135,68 +312,101 @@ def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] =
     For other extensions, users can provide their own decoder.
 
     Args:
-        sample: sample, modified in place
+        sample: sample, modified in place if it is a dict and inplace is True;
+            other mappings (such as SampleView) are copied into a new dict
+        inplace: set to False to leave a dict sample unchanged and decode into a copy
     """
-    sample = dict(sample)
+    if not inplace or not isinstance(sample, dict):
+        sample = dict(sample)
+    # only values of existing keys are replaced, so iterating over items() is safe
     for key, stream in sample.items():
-        extensions = key.split(".")
-        if len(extensions) < 1:
+        if key.startswith("__"):
             continue
-        extension = extensions[-1]
-        if extension in ["gz"]:
-            decompressed = gzip.decompress(stream.read())
-            stream = io.BytesIO(decompressed)
-            if len(extensions) < 2:
+        rest, _, extension = key.rpartition(".")
+        if extension == "gz":
+            stream = io.BytesIO(gzip.decompress(as_stream(stream).read()))
+            extension = rest.rpartition(".")[2]
+            if extension == "":
                 sample[key] = stream
                 continue
-            extension = extensions[-2]
-        if key.startswith("__"):
-            continue
-        elif extension in ["txt", "text"]:
-            value = stream.read()
-            sample[key] = value.decode("utf-8")
-        elif extension in ["cls", "cls2"]:
-            value = stream.read()
-            sample[key] = int(value.decode("utf-8"))
-        elif extension in ["jpg", "png", "ppm", "pgm", "pbm", "pnm"]:
-            if format == "PIL":
-                import PIL.Image
-
-                sample[key] = PIL.Image.open(stream)
-            elif format == "numpy":
-                import numpy as np
-
-                sample[key] = np.asarray(PIL.Image.open(stream))
-            else:
-                raise ValueError(f"Unknown format: {format}")
-        elif extension == "json":
-            import json
+        decoder = default_decoders.get(extension)
+        if decoder is not None:
+            sample[key] = decoder(as_stream(stream), format)
+    return sample
 
-            value = stream.read()
-            sample[key] = json.loads(value)
-        elif extension == "npy":
-            import numpy as np
 
-            sample[key] = np.load(stream)
-        elif extension == "mp":
-            import msgpack
+def as_stream(value):
+    """Return a readable stream for file contents given as a stream or a uint8 tensor."""
+    if isinstance(value, torch.Tensor):
+        return io.BytesIO(value.numpy().tobytes())
+    return value
 
-            value = stream.read()
-            sample[key] = msgpack.unpackb(value, raw=False)
-        elif extension in ["pt", "pth"]:
-            import torch
 
-            sample[key] = torch.load(stream)
-        elif extension in ["pickle", "pkl"]:
-            import pickle
+def bytes_to_tensors(sample: Dict[str, Any], *, keys):
+    """Replace the file contents for the given keys in a sample with uint8 tensors.
 
-            sample[key] = pickle.load(stream)
+    DataLoader sends tensors from worker processes through shared memory
+    instead of pickling them, so this is useful as the last transformation
+    for large files (e.g. partial(bytes_to_tensors, keys=[".jpg"])) that are
+    decoded in the main process. Each tensor is its own shared memory segment,
+    so small files are cheaper to leave as bytes. The tensors have different
+    lengths, so use the DataLoader with batch_size=None or a collate_fn that
+    doesn't stack them. default_decoder accepts the resulting tensors.
+    """
+    for key in keys:
+        value = sample.get(key)
+        if isinstance(value, io.BytesIO):
+            value = value.getbuffer()
+        elif not isinstance(value, (bytes, bytearray, memoryview)):
+            continue
+        if len(value) == 0:
+            sample[key] = torch.empty(0, dtype=torch.uint8)
+        else:
+            sample[key] = torch.frombuffer(bytearray(value), dtype=torch.uint8)
     return sample
 
 
 open_itfs = {}
 
 
+class SampleView(Mapping):
+    """A lazy view of a single sample in an IndexedTarSamples.
+
+    File contents are only read from the tar file when the corresponding
+    key is accessed, so transformations that use only some of the files
+    in a sample don't pay for reading the rest. Additional keys (such as
+    "__key__" and the metadata added by ShardListDataset) can be set and
+    shadow file contents. Use dict(view) to materialize the sample.
+    """
+
+    __slots__ = ("reader", "by_ext", "extra")
+
+    def __init__(self, reader, by_ext, key):
+        self.reader = reader
+        self.by_ext = by_ext
+        self.extra = {"__key__": key}
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        return self.reader.get_file(self.by_ext[key])[1]
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.extra or key in self.by_ext
+
+    def __iter__(self):
+        yield from self.by_ext
+        for key in self.extra:
+            if key not in self.by_ext:
+                yield key
+
+    def __len__(self):
+        return len(self.by_ext) + sum(key not in self.by_ext for key in self.extra)
+
+
 class IndexedTarSamples:
     """A class that accesses samples in a tar file. The tar file must follow
     WebDataset conventions. The tar file is indexed when the IndexedTarSamples
@@ -218,6 +428,7 @@ class IndexedTarSamples:
         expected_size=None,
         use_mmap=True,
         index_file=find_index_file,
+        verify_cache=None,
     ):
         assert path is not None or stream is not None
 
@@ -225,17 +436,31 @@ class IndexedTarSamples:
         self.path = path
         stream = self.stream = stream or open(path, "rb")
 
-        # verify the MD5 sum
+        # verify the MD5 sum; for files, skip this if the sidecar in the verify_cache
+        # directory records the sum for the same size and mtime, otherwise overlap it
+        # with indexing and only wait for the result before the first sample is returned
+        self.md5sum = md5sum
+        self.verify_cache = verify_cache
+        self.md5sum_future = None
         if md5sum is not None:
-            stream.seek(0)
-            got = compute_file_md5sum(stream)
-            assert got == md5sum, f"MD5 sum mismatch: expected {md5sum}, got {got}"
-            stream.seek(0)
+            got = cached_file_md5sum(path, verify_cache) if path is not None else None
+            if got is not None:
+                assert got == md5sum, f"MD5 sum mismatch: expected {md5sum}, got {got}"
+            elif path is not None:
+                self.submit_md5sum()
+            else:
+                stream.seek(0)
+                got = compute_file_md5sum(stream)
+                assert got == md5sum, f"MD5 sum mismatch: expected {md5sum}, got {got}"
+                stream.seek(0)
 
         # use either the mmap or the stream based implementation
         if use_mmap:
             self.reader = MMIndexedTar(stream)
         else:
+            # index file names are derived from the path, not the stream
+            if callable(index_file):
+                index_file = index_file(path) if path is not None else None
             self.reader = TarFileReader(stream, index_file=index_file)
 
         # Get list of all files in stream
@@ -252,7 +477,30 @@ class IndexedTarSamples:
 
         self.uuid = str(uuid.uuid4())
 
+    def submit_md5sum(self):
+        """Start verifying the MD5 sum of the file in the background."""
+        self.md5sum_future = get_verify_pool().submit(
+            compute_and_record_file_md5sum, self.path, self.verify_cache
+        )
+        self.md5sum_pid = os.getpid()
+
+    def check_md5sum(self):
+        """Wait for a pending background MD5 verification and check the result."""
+        if self.md5sum_pid != os.getpid():
+            # the thread computing the sum didn't survive a fork, so the inherited
+            # future never completes; verify again in this process
+            self.submit_md5sum()
+        got = self.md5sum_future.result()
+        assert (
+            got == self.md5sum
+        ), f"MD5 sum mismatch: expected {self.md5sum}, got {got}"
+        # only drop the future once it has passed, so a failure raises on every access
+        self.md5sum_future = None
+
     def close(self):
+        if self.md5sum_future is not None and self.md5sum_pid == os.getpid():
+            self.md5sum_future.cancel()
+        self.md5sum_future = None
         self.reader.close()
         if not self.stream.closed:
             self.stream.close()
@@ -261,13 +509,14 @@ class IndexedTarSamples:
         return len(self.samples)
 
     def __getitem__(self, idx):
+        if self.md5sum_future is not None:
+            self.check_md5sum()
         # Get indexes of files for the sample at index idx
         indexes = self.samples[idx]
         sample = {}
         key = None
-        for i in indexes:
-            # Get filename and data for the file at index i
-            fname, data = self.reader.get_file(i)
+        # Get filenames and data for all files of the sample at once
+        for fname, data in self.reader.get_files(indexes):
             # Split filename into key and extension
             k, ext = splitname(fname)
             # Make sure all files in sample have same key
@@ -278,6 +527,21 @@ class IndexedTarSamples:
         sample["__key__"] = key
         return sample
 
+    def get_view(self, idx):
+        """Return a SampleView for the sample at index idx without reading any file contents."""
+        if self.md5sum_future is not None:
+            self.check_md5sum()
+        names = self.reader.names()
+        by_ext = {}
+        key = None
+        for i in self.samples[idx]:
+            k, ext = splitname(names[i])
+            # Make sure all files in sample have same key
+            key = key or k
+            assert key == k
+            by_ext[ext] = i
+        return SampleView(self.reader, by_ext, key)
+
     def __str__(self):
         return f"<IndexedTarSamples-{id(self)} {self.path}>"
 
@@ -285,15 +549,49 @@ class IndexedTarSamples:
         return str(self)
 
 
-def hash_localname(dldir="/tmp/_wids_cache"):
-    os.makedirs(dldir, exist_ok=True)
+@lru_cache(maxsize=4096)
+def hash_urldir(dirname):
+    """Memoized hash_dataset_name for the URL directories of shards."""
+    return hash_dataset_name(dirname)
 
-    connection = sqlite3.connect(os.path.join(dldir, "cache.db"))
-    cursor = connection.cursor()
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)"
-    )
-    connection.commit()
+
+def hash_localname(dldir="/tmp/_wids_cache", flush_every=100):
+    """Return a function that maps URLs to hashed local names in dldir.
+
+    The URL to local name mapping is recorded in an sqlite database in dldir.
+    Each process (including forked DataLoader workers) opens its own connection
+    in WAL mode, and inserts are batched and flushed every flush_every entries
+    and when the process exits, so resolving a shard does not cost an fsync.
+    """
+    os.makedirs(dldir, exist_ok=True)
+    dbname = os.path.join(dldir, "cache.db")
+    state = dict(pid=None, connection=None, pending=[])
+
+    def get_connection():
+        if state["pid"] != os.getpid():
+            # never share a connection (or unflushed entries) with a parent process
+            connection = sqlite3.connect(dbname)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)"
+            )
+            connection.commit()
+            state.update(pid=os.getpid(), connection=connection, pending=[])
+            # atexit handlers don't run in multiprocessing children (they leave via
+            # os._exit), but multiprocessing finalizers do; children discard the
+            # finalizers inherited from the parent, so register one per process
+            Finalize(None, flush, exitpriority=10)
+        return state["connection"]
+
+    def flush():
+        connection = get_connection()
+        if state["pending"]:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", state["pending"]
+            )
+            connection.commit()
+            state["pending"] = []
 
     def f(shard):
         """Given a URL, return a local name for the shard."""
@@ -304,21 +602,20 @@ def hash_localname(dldir="/tmp/_wids_cache"):
             ].decode()
             return os.path.join(dldir, "pipe__" + hex32)
         else:
-            # we hash the host and directory components into a 16 character string
-            dirname = urldir(shard)
-            hex16 = base64.urlsafe_b64encode(hashlib.sha256(dirname.encode()).digest())[
-                :16
-            ].decode()
+            # we hash the host and directory components into a 16 character string;
+            # shards usually share a few directories, so this hits the memoized hash
+            hex16 = hash_urldir(urldir(shard))
             # the cache name is the concatenation of the hex16 string and the file name component of the URL
             cachename = "data__" + hex16 + "__" + os.path.basename(urlparse(shard).path)
             checksum = None
-            cursor.execute(
-                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
-                (shard, cachename, checksum),
-            )
-            connection.commit()
+            get_connection()
+            state["pending"].append((shard, cachename, checksum))
+            if len(state["pending"]) >= flush_every:
+                flush()
             return os.path.join(dldir, cachename)
 
+    get_connection()
+    f.flush = flush
     return f
 
 
@@ -358,6 +655,10 @@ class LRUShards:
         self.localname = localname
         # the cache contains the local name as the key and the downloaded path as the value
         self.lru = LRUCache(lru_size, release_handler=self.release_handler)
+        # background downloads of shards that are likely to be needed soon
+        self.prefetch_pool = None
+        self.prefetch_pid = None
+        self.pending = {}
         # keep statistics
         self.reset_stats()
 
@@ -371,14 +672,48 @@ class LRUShards:
     def release_handler(self, key, value):
         value.close()
 
+    def check_pid(self):
+        """Drop the prefetch pool and futures inherited through a fork.
+
+        Threads don't survive a fork, so futures pending in the parent never
+        complete in a DataLoader worker; each worker starts its own pool.
+        """
+        if self.prefetch_pid != os.getpid():
+            self.prefetch_pool = None
+            self.prefetch_pid = os.getpid()
+            self.pending = {}
+
     def clear(self):
+        self.check_pid()
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
         self.lru.clear()
 
+    def prefetch(self, url):
+        """Start downloading the shard in the background if it isn't cached or pending."""
+        self.check_pid()
+        if url in self.lru or url in self.pending:
+            return
+        if self.prefetch_pool is None:
+            self.prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending[url] = self.prefetch_pool.submit(
+            download_only, url, self.localname(url)
+        )
+
     def get_shard(self, url):
         assert isinstance(url, str)
         self.accesses += 1
         if url not in self.lru:
             local = self.localname(url)
+            self.check_pid()
+            future = self.pending.pop(url, None)
+            if future is not None:
+                try:
+                    future.result()
+                except Exception:
+                    # retry (and report errors) with the regular download below
+                    pass
             with download_and_open(url, local) as stream:
                 itf = IndexedTarSamples(path=local, stream=stream)
             self.lru[url] = itf
@@ -451,6 +786,9 @@ class ShardListDataset(Dataset[T]):
         keep=False,
         base=None,
         options=None,
+        lazy=False,
+        prefetch=False,
+        pinned_fraction=0.0,
     ):
         """Create a ShardListDataset.
 
@@ -459,6 +797,12 @@ class ShardListDataset(Dataset[T]):
             cache_size: the number of shards to keep in the cache
             lru_size: the number of shards to keep in the LRU cache
             localname: a function that maps URLs to local filenames
+            lazy: pass SampleView objects instead of dicts to the transformations,
+                so that files are only read when accessed
+            prefetch: download the next shard in the background whenever a new shard
+                is opened; useful when shards are mostly visited in order
+            pinned_fraction: fraction of the LRU cache reserved for a fixed random subset
+                of shards that is never evicted, so that some shards stay cached across epochs
 
         Note that there are two caches: an on-disk directory, and an in-memory LRU cache.
         """
@@ -482,8 +826,13 @@ class ShardListDataset(Dataset[T]):
             self.dataset_name = dataset_name or hash_dataset_name(str(shards))
 
         self.lengths = [shard["nsamples"] for shard in self.shards]
-        self.cum_lengths = np.cumsum(self.lengths)
-        self.total_length = self.cum_lengths[-1]
+        self.cum_lengths = np.cumsum(np.asarray(self.lengths, dtype=np.int64))
+        self.total_length = int(self.cum_lengths[-1])
+
+        # plain list for bisect, plus the index range of the most recently used shard
+        self._cum_lengths_list = self.cum_lengths.tolist()
+        # (lo, hi, shard_idx) of the last shard looked up, replaced as a whole
+        self._last_shard = (0, 0, -1)
 
         if cache_dir is not None:
             # when a cache dir is explicitly given, we download files into
@@ -519,6 +868,8 @@ class ShardListDataset(Dataset[T]):
                 file=sys.stderr,
             )
         self.transformations = interpret_transformations(transformations)
+        self.lazy = lazy
+        self.prefetch = prefetch
 
         if lru_size > 200:
             warnings.warn(
@@ -526,6 +877,13 @@ class ShardListDataset(Dataset[T]):
             )
         self.cache = LRUShards(lru_size, localname=self.localname, keep=keep)
 
+        # pin the same pseudo-random subset of shards in every worker
+        npinned = min(int(lru_size * pinned_fraction), lru_size - 1, len(self.shards))
+        if npinned > 0:
+            rng = np.random.default_rng(0)
+            for i in rng.choice(len(self.shards), npinned, replace=False).tolist():
+                self.cache.lru.pin(self.shards[i]["url"])
+
     def add_transform(self, transform):
         """Add a transformation to the dataset."""
         self.transformations.append(transform)
@@ -553,15 +911,20 @@ class ShardListDataset(Dataset[T]):
 
     def get_shard(self, index):
         """Get the shard and index within the shard corresponding to the given index."""
-        # Find the shard corresponding to the given index.
-        shard_idx = np.searchsorted(self.cum_lengths, index, side="right")
+        # Find the shard corresponding to the given index. Samplers usually
+        # yield runs of indexes from the same shard, so check the last one first.
+        lo, hi, shard_idx = self._last_shard
+        if not lo <= index < hi:
+            shard_idx = bisect.bisect_right(self._cum_lengths_list, index)
+            lo = self._cum_lengths_list[shard_idx - 1] if shard_idx > 0 else 0
+            hi = self._cum_lengths_list[shard_idx]
+            self._last_shard = (lo, hi, shard_idx)
+            if self.prefetch and shard_idx + 1 < len(self.shards):
+                self.cache.prefetch(self.shards[shard_idx + 1]["url"])
 
         # Figure out which index within the shard corresponds to the
-        # given index.
-        if shard_idx == 0:
-            inner_idx = index
-        else:
-            inner_idx = index - self.cum_lengths[shard_idx - 1]
+        # given index. This is a Python int even if index is a numpy scalar.
+        inner_idx = int(index) - lo
 
         # Get the shard and return the corresponding element.
         desc = self.shards[shard_idx]
@@ -572,7 +935,10 @@ class ShardListDataset(Dataset[T]):
     def __getitem__(self, index):
         """Return the sample corresponding to the given index."""
         shard, inner_idx, desc = self.get_shard(index)
-        sample = shard[inner_idx]
+        if self.lazy:
+            sample = shard.get_view(inner_idx)
+        else:
+            sample = shard[inner_idx]
 
         # Check if we're missing the cache too often.
         self.check_cache_misses()
@@ -622,16 +988,21 @@ def intersect_ranges(rangelist, r):
 
 
 def iterate_ranges(ranges, rng, indexshuffle=True, shardshuffle=True):
-    """Iterate over the ranges in a random order."""
-    shard_indexes = list(range(len(ranges)))
+    """Iterate over the ranges in a random order.
+
+    The rng is a numpy Generator; permutations are computed in numpy and
+    converted to Python ints one range at a time.
+    """
     if shardshuffle:
-        rng.shuffle(shard_indexes)
+        shard_indexes = rng.permutation(len(ranges)).tolist()
+    else:
+        shard_indexes = range(len(ranges))
     for i in shard_indexes:
         lo, hi = ranges[i]
-        sample_indexes = list(range(lo, hi))
         if indexshuffle:
-            rng.shuffle(sample_indexes)
-        yield from sample_indexes
+            yield from (rng.permutation(hi - lo) + lo).tolist()
+        else:
+            yield from range(lo, hi)
 
 
 class ShardListSampler(Sampler):
@@ -652,18 +1023,41 @@ class ShardListSampler(Sampler):
     be added.
     """
 
-    def __init__(self, dataset, *, lengths=None, seed=0, shufflefirst=False):
+    def __init__(
+        self, dataset, *, lengths=None, seed=0, shufflefirst=False, alternate=False
+    ):
         if lengths is None:
             lengths = list(dataset.lengths)
         self.ranges = lengths_to_ranges(lengths)
         self.seed = seed
         self.shufflefirst = shufflefirst
+        self.alternate = alternate
         self.epoch = 0
 
+    def alternating_shard_order(self):
+        """Return the shard order used when alternate=True.
+
+        This is a fixed order (shuffled once if shufflefirst is set) that is
+        reversed on odd epochs, so the shards still in the cache at the end of
+        an epoch are the first ones used in the next epoch.
+        """
+        if self.shufflefirst:
+            rng = np.random.default_rng(self.seed % 2**63)
+            order = rng.permutation(len(self.ranges)).tolist()
+        else:
+            order = list(range(len(self.ranges)))
+        if self.epoch % 2 == 1:
+            order.reverse()
+        return order
+
     def __iter__(self):
-        self.rng = random.Random(self.seed + 1289738273 * self.epoch)
-        shardshuffle = self.shufflefirst or self.epoch > 0
-        yield from iterate_ranges(self.ranges, self.rng, shardshuffle=shardshuffle)
+        self.rng = np.random.default_rng((self.seed + 1289738273 * self.epoch) % 2**63)
+        if self.alternate:
+            ranges = [self.ranges[i] for i in self.alternating_shard_order()]
+            yield from iterate_ranges(ranges, self.rng, shardshuffle=False)
+        else:
+            shardshuffle = self.shufflefirst or self.epoch > 0
+            yield from iterate_ranges(self.ranges, self.rng, shardshuffle=shardshuffle)
         self.epoch += 1
 
 
@@ -702,7 +1096,7 @@ class ChunkedSampler(Sampler):
         self.epoch = epoch
 
     def __iter__(self):
-        self.rng = random.Random(self.seed + 1289738273 * self.epoch)
+        self.rng = np.random.default_rng((self.seed + 1289738273 * self.epoch) % 2**63)
         shardshuffle = self.shufflefirst or self.epoch > 0
         yield from iterate_ranges(
             self.ranges,
@@ -144,3 +144,17 @@ def download_and_open(remote, local, mode="rb", handlers=default_cmds, verbose=F
             key = tuple(str(x) for x in [remote, local, mode, current_time])
             open_objects[key] = result
         return result
+
+
+def download_only(remote, local, handlers=default_cmds, verbose=False):
+    """Download remote to local unless it is already there, without opening it.
+
+    Unlike download_and_open, this doesn't touch open_objects, so it is safe
+    to call from a background thread.
+    """
+    with ULockFile(local + ".lock"):
+        if not os.path.exists(local):
+            if verbose:
+                print("downloading", remote, "to", local, file=sys.stderr)
+            download_file(remote, local, handlers=handlers)
+    return local
@@ -7,6 +7,16 @@ class LRUCache:
         self.capacity = capacity
         self.cache = OrderedDict()
         self.release_handler = release_handler
+        self.pinned = set()
+
+    def pin(self, key):
+        """Never evict the given key once it is in the cache.
+
+        At least one slot must stay unpinned so that new entries can be added.
+        """
+        if key not in self.pinned:
+            assert len(self.pinned) < self.capacity - 1, "too many pinned keys"
+            self.pinned.add(key)
 
     def __getitem__(self, key):
         """Return the value associated with the given key, or None."""
@@ -21,7 +31,9 @@ class LRUCache:
             self.cache.move_to_end(key)
         self.cache[key] = value
         if len(self.cache) > self.capacity:
-            key, value = self.cache.popitem(last=False)
+            # evict the least recently used key that isn't pinned
+            key = next(k for k in self.cache if k not in self.pinned)
+            value = self.cache.pop(key)
             if self.release_handler is not None:
                 self.release_handler(key, value)
 
@@ -5,6 +5,8 @@ import mmap
 import os
 import struct
 
+import numpy as np
+
 TarHeader = collections.namedtuple(
     "TarHeader",
     [
@@ -57,6 +59,7 @@ class MMIndexedTar:
         self.mmapped_file = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
         if cleanup_callback:
             cleanup_callback(fname, self.stream.fileno(), "start")
+        self._by_name = None
         self._build_index()
 
     def close(self, dispose=False):
@@ -66,8 +69,9 @@ class MMIndexedTar:
         self.stream.close()
 
     def _build_index(self):
-        self.by_name = {}
-        self.by_index = []
+        fnames = []
+        offsets = []
+        sizes = []
         offset = 0
         while offset >= 0 and offset < len(self.mmapped_file):
             header = parse_tar_header(self.mmapped_file[offset : offset + 500])
@@ -79,12 +83,22 @@ class MMIndexedTar:
                 except ValueError as exn:
                     print(header)
                     raise exn
-                self.by_name[name] = offset
-                self.by_index.append((name, offset, size))
+                fnames.append(name)
+                offsets.append(offset)
+                sizes.append(size)
             offset = next_header(offset, header)
+        self.fnames = fnames
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.sizes = np.array(sizes, dtype=np.int64)
+
+    @property
+    def by_name(self):
+        if self._by_name is None:
+            self._by_name = {name: i for i, name in enumerate(self.fnames)}
+        return self._by_name
 
     def names(self):
-        return self.by_name.keys()
+        return self.fnames
 
     def get_at_offset(self, offset):
         header = parse_tar_header(self.mmapped_file[offset : offset + 500])
@@ -94,30 +108,42 @@ class MMIndexedTar:
         return name, self.mmapped_file[start:end]
 
     def get_at_index(self, index):
-        name, offset, size = self.by_index[index]
-        return self.get_at_offset(offset)
+        start = int(self.offsets[index]) + 512
+        return (
+            self.fnames[index],
+            self.mmapped_file[start : start + int(self.sizes[index])],
+        )
 
     def get_by_name(self, name):
-        offset = self.by_name[name]
-        return self.get_at_offset(offset)
+        return self.get_at_index(self.by_name[name])
 
     def __iter__(self):
-        for name, offset, size in self.by_index:
-            yield name, self.mmapped_file[offset + 512 : offset + 512 + size]
+        for i in range(len(self.fnames)):
+            yield self.get_at_index(i)
 
     def __getitem__(self, key):
-        if isinstance(key, int):
-            return self.get_at_index(key)
-        else:
+        if isinstance(key, str):
             return self.get_by_name(key)
+        else:
+            return self.get_at_index(key)
 
     def __len__(self):
-        return len(self.by_index)
+        return len(self.fnames)
 
     def get_file(self, i):
         fname, data = self.get_at_index(i)
         return fname, io.BytesIO(data)
 
+    def get_files(self, indexes):
+        """Return (name, stream) pairs for several files, slicing a single view of the mmap."""
+        starts = (self.offsets[indexes] + 512).tolist()
+        ends = (self.offsets[indexes] + 512 + self.sizes[indexes]).tolist()
+        with memoryview(self.mmapped_file) as view:
+            return [
+                (self.fnames[i], io.BytesIO(view[start:end]))
+                for i, start, end in zip(indexes, starts, ends)
+            ]
+
 
 def keep_while_reading(fname, fd, phase, delay=0.0):
     """This is a possible cleanup callback for cleanup_callback of MIndexedTar.
@@ -7,10 +7,17 @@ import tarfile
 
 import numpy as np
 
+# matches the extension of names like "shard.tar._12_"
+numbered_ext_re = re.compile("._[0-9]+_$")
+
 
 def find_index_file(file):
+    """Return the name of the index file for a tar file.
+
+    This is computed from the file name alone, without touching the file system.
+    """
     prefix, last_ext = os.path.splitext(file)
-    if re.match("._[0-9]+_$", last_ext):
+    if numbered_ext_re.match(last_ext):
         return prefix + ".index"
     else:
         return file + ".index"
@@ -78,6 +85,25 @@ class TarFileReader:
         file_bytes = self.tar_file.fileobj.read(size)
         return name, io.BytesIO(file_bytes)
 
+    def get_files(self, indexes):
+        """Return (name, stream) pairs for several files.
+
+        Files of a sample are usually adjacent in the tar file, so they are
+        fetched with a single read of the byte range spanning all of them.
+        """
+        spans = [(int(self.index[i][0]), int(self.index[i][1])) for i in indexes]
+        lo = min(offset for offset, size in spans)
+        hi = max(offset + size for offset, size in spans)
+        # fall back to separate reads if the files are far apart
+        if hi - lo > sum(size for offset, size in spans) + 1024 * len(spans):
+            return [self.get_file(i) for i in indexes]
+        self.tar_file.fileobj.seek(lo)
+        data = self.tar_file.fileobj.read(hi - lo)
+        return [
+            (self.fnames[i], io.BytesIO(data[offset - lo : offset - lo + size]))
+            for i, (offset, size) in zip(indexes, spans)
+        ]
+
     def close(self):
         # Close the tar file
         self.tar_file.close()